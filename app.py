@@ -1,90 +1,248 @@
 from flask import Flask, render_template, jsonify, request
-import json
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import FileSystemBytecodeCache
+import importlib.util
+import orjson
 import os
+import queue
+import threading
+import time
+import pandas as pd
 from datetime import datetime
 from sse_analyzer import SSEScotlandCapacityAnalyzer
 import math
 
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider that serializes with orjson instead of the stdlib json module
+    """
+    
+    def dumps(self, obj, **kwargs):
+        option = ORJSON_OPTIONS | orjson.OPT_SORT_KEYS if self.sort_keys else ORJSON_OPTIONS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Compile templates once per machine rather than once per process. With no
+# directory given, Jinja uses a per-user temp directory it checks is private
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 app.config['SECRET_KEY'] = 'AHHHHHHHHHHHHHHHHHHHHHHHHHHHh'
 
+# Shared analyzer so its HTTP connections are reused across refreshes
+analyzer = SSEScotlandCapacityAnalyzer()
+
 # Global variable to store cached data
 capacity_data = None
+formatted_data = None
+game_constants = None
 last_updated = None
 
-def get_capacity_data(force_refresh=False):
+KETTLE_POWER = 3.0  # kW per kettle
+
+# Guards so only one refresh runs at a time
+initial_load_lock = threading.Lock()
+refresh_lock = threading.Lock()
+refreshing = False
+
+# Background writer for the JSON cache file
+cache_write_queue = queue.Queue(maxsize=4)
+cache_writer_lock = threading.Lock()
+cache_writer = None
+
+# Rendered dashboard HTML, reused until the data's last_updated changes
+rendered_index_html = None
+rendered_index_key = None
+
+CACHE_FILE = 'data_cache.json'
+RECORDS_CACHE_FILE = 'data_cache.parquet'
+
+# The records cache needs a parquet engine, which is optional; without one it is skipped
+PARQUET_ENGINE_AVAILABLE = any(
+    importlib.util.find_spec(engine) is not None for engine in ('pyarrow', 'fastparquet')
+)
+if not PARQUET_ENGINE_AVAILABLE:
+    print("No parquet engine installed (pyarrow or fastparquet), records cache disabled")
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 3600))  # seconds
+
+def build_capacity_data(totals, records_count, updated_at):
+    """
+    Build the cached capacity summary from Scotland capacity totals
+    """
+    return {
+        'totals': totals,
+        'records_count': records_count,
+        'last_updated': updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+        # Epoch seconds of the fetch, used to judge freshness of the shared cache file
+        'fetched_at': updated_at.timestamp(),
+        'summary': {
+            'accepted_capacity': totals.get('accepted_registered_capacity', {}).get('total_mw', 0),
+            'connected_capacity': totals.get('connected_registered_capacity', {}).get('total_mw', 0),
+            'max_export_capacity': totals.get('maximum_export_capacity', {}).get('total_mw', 0),
+            'max_import_capacity': totals.get('maximum_import_capacity', {}).get('total_mw', 0),
+            'grand_total': sum(totals[cap]['total_mw'] for cap in totals)
+        }
+    }
+
+def load_shared_cache():
+    """
+    Load the JSON cache file if its data was fetched within CACHE_TTL seconds.
+    The fetch time is stored in the payload, since the file's mtime changes on
+    every clone or copy.
+    """
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            data = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    
+    fetched_at = data.get('fetched_at')
+    if fetched_at is None or time.time() - fetched_at >= CACHE_TTL:
+        return None
+    
+    return data, datetime.fromtimestamp(fetched_at)
+
+def write_cache_file(data):
+    """
+    Write the JSON cache file atomically so readers never see a partial file
+    """
+    tmp_path = f"{CACHE_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(data, option=ORJSON_OPTIONS))
+    os.replace(tmp_path, CACHE_FILE)
+
+def cache_writer_loop():
+    """
+    Write queued capacity data to the cache file, run on a background thread
+    """
+    while True:
+        data = cache_write_queue.get()
+        try:
+            write_cache_file(data)
+        except Exception as e:
+            print(f"Error saving cache file: {e}")
+        finally:
+            cache_write_queue.task_done()
+
+def queue_cache_write(data):
     """
-    Get capacity data, using cache unless force_refresh is True
+    Hand capacity data to the background cache writer, skipping it if the writer is backed up
     """
-    global capacity_data, last_updated
+    global cache_writer
     
-    if capacity_data is None or force_refresh:
-        print("Fetching fresh data from API...")
-        analyzer = SSEScotlandCapacityAnalyzer()
+    # Started lazily, and only from background refreshes, so the thread never exists in the
+    # gunicorn master and each forked worker gets its own writer and a queue no thread holds
+    with cache_writer_lock:
+        if cache_writer is None or not cache_writer.is_alive():
+            cache_writer = threading.Thread(target=cache_writer_loop, daemon=True)
+            cache_writer.start()
+    
+    try:
+        cache_write_queue.put_nowait(data)
+    except queue.Full:
+        print("Cache writer is busy, skipping cache file update")
+
+def save_cache_file(data, in_background=True):
+    """
+    Save capacity data to the cache file, via the writer thread or synchronously
+    """
+    if in_background:
+        queue_cache_write(data)
+        return
+    
+    try:
+        write_cache_file(data)
+    except Exception as e:
+        print(f"Error saving cache file: {e}")
+
+def compute_capacity_data(write_in_background=True):
+    """
+    Fetch, filter and total the capacity data, falling back to the cache files
+    """
+    print("Fetching fresh data from API...")
+    
+    # Let the datastore filter and total the records server-side
+    sql_totals = analyzer.fetch_scotland_totals()
+    if sql_totals is not None:
+        data = build_capacity_data(sql_totals['totals'], sql_totals['records_count'], datetime.now())
         
-        # Fetch data
-        df = analyzer.fetch_scotland_data(limit=5000)
+        # The SQL path has no records to store, so drop the older records cache
+        # rather than let the fallback prefer it over this newer summary
+        try:
+            os.remove(RECORDS_CACHE_FILE)
+        except FileNotFoundError:
+            pass
         
-        if not df.empty:
-            # Filter for Scotland
-            scotland_df = analyzer.filter_scotland_data(df)
-            
-            if scotland_df.empty:
-                scotland_df = df
-            
-            # Calculate totals
-            totals = analyzer.calculate_capacity_totals(scotland_df)
-            
-            capacity_data = {
-                'totals': totals,
-                'records_count': len(scotland_df),
-                'last_updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'summary': {
-                    'accepted_capacity': totals.get('accepted_registered_capacity', {}).get('total_mw', 0),
-                    'connected_capacity': totals.get('connected_registered_capacity', {}).get('total_mw', 0),
-                    'max_export_capacity': totals.get('maximum_export_capacity', {}).get('total_mw', 0),
-                    'max_import_capacity': totals.get('maximum_import_capacity', {}).get('total_mw', 0),
-                    'grand_total': sum(totals[cap]['total_mw'] for cap in totals)
-                }
-            }
-            
-            last_updated = datetime.now()
-            
-            # Save to file for persistence
-            with open('data_cache.json', 'w') as f:
-                json.dump(capacity_data, f, indent=2)
-                
-        else:
-            # Try to load from cache if API fails
+        save_cache_file(data, write_in_background)
+        
+        return data
+    
+    # Fetch data
+    df = analyzer.fetch_scotland_data(limit=5000)
+    
+    if not df.empty:
+        # Filter for Scotland
+        scotland_df = analyzer.filter_scotland_data(df)
+        
+        if scotland_df.empty:
+            scotland_df = df
+        
+        # Calculate totals
+        totals = analyzer.calculate_capacity_totals(scotland_df)
+        data = build_capacity_data(totals, len(scotland_df), datetime.now())
+        
+        # Save to file for persistence: raw records as parquet, summary as JSON
+        if PARQUET_ENGINE_AVAILABLE:
             try:
-                with open('data_cache.json', 'r') as f:
-                    capacity_data = json.load(f)
-                print("Loaded data from cache file")
-            except FileNotFoundError:
-                capacity_data = {
-                    'totals': {},
-                    'records_count': 0,
-                    'last_updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'summary': {
-                        'accepted_capacity': 0,
-                        'connected_capacity': 0,
-                        'max_export_capacity': 0,
-                        'max_import_capacity': 0,
-                        'grand_total': 0
-                    }
-                }
+                scotland_df.to_parquet(RECORDS_CACHE_FILE, compression='zstd')
+            except Exception as e:
+                print(f"Error saving records cache: {e}")
+        
+        save_cache_file(data, write_in_background)
+        
+        return data
     
-    return capacity_data
+    # Try to load from cache if API fails
+    if PARQUET_ENGINE_AVAILABLE and os.path.exists(RECORDS_CACHE_FILE):
+        try:
+            scotland_df = pd.read_parquet(RECORDS_CACHE_FILE)
+            updated_at = datetime.fromtimestamp(os.path.getmtime(RECORDS_CACHE_FILE))
+            totals = analyzer.calculate_capacity_totals(scotland_df)
+            data = build_capacity_data(totals, len(scotland_df), updated_at)
+            print("Loaded data from records cache file")
+            return data
+        except Exception as e:
+            print(f"Error loading records cache: {e}")
+    
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            data = orjson.loads(f.read())
+        print("Loaded data from cache file")
+        return data
+    except FileNotFoundError:
+        return {
+            'totals': {},
+            'records_count': 0,
+            'last_updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'summary': {
+                'accepted_capacity': 0,
+                'connected_capacity': 0,
+                'max_export_capacity': 0,
+                'max_import_capacity': 0,
+                'grand_total': 0
+            }
+        }
 
-@app.route('/')
-def index():
+def format_capacity_data(data):
     """
-    Main dashboard page
+    Format capacity numbers for display
     """
-    data = get_capacity_data()
-    
-    # Format numbers for display
-    formatted_data = {
+    return {
         'accepted_capacity': f"{data['summary']['accepted_capacity']:,.2f}",
         'connected_capacity': f"{data['summary']['connected_capacity']:,.2f}",
         'max_export_capacity': f"{data['summary']['max_export_capacity']:,.2f}",
@@ -93,8 +251,112 @@ def index():
         'records_count': f"{data['records_count']:,}",
         'last_updated': data['last_updated']
     }
+
+def compute_game_constants(data):
+    """
+    Precompute the kettle game values that only depend on capacity data
+    """
+    available_capacity = data['summary']['connected_capacity']
+    
+    return {
+        'available_capacity': available_capacity,
+        'kettles_to_blackout': math.ceil((available_capacity * 1000) / KETTLE_POWER)  # Convert MW to kW
+    }
+
+def set_capacity_data(data, updated_at):
+    """
+    Store new capacity data along with its display formatting and game constants
+    """
+    global capacity_data, formatted_data, game_constants, last_updated
+    
+    formatted_data = format_capacity_data(data)
+    game_constants = compute_game_constants(data)
+    capacity_data = data
+    last_updated = updated_at
+
+def refresh_capacity_data():
+    """
+    Recompute capacity data and swap it in, run on a background thread
+    """
+    global refreshing
+    
+    try:
+        set_capacity_data(compute_capacity_data(), datetime.now())
+    except Exception as e:
+        print(f"Error refreshing capacity data: {e}")
+    finally:
+        with refresh_lock:
+            refreshing = False
+
+def start_background_refresh():
+    """
+    Start a background refresh unless one is already running
+    """
+    global refreshing
+    
+    with refresh_lock:
+        if refreshing:
+            return False
+        refreshing = True
+    
+    threading.Thread(target=refresh_capacity_data, daemon=True).start()
+    return True
+
+def get_capacity_data(force_refresh=False):
+    """
+    Get capacity data, using cache unless force_refresh is True or it is older than CACHE_TTL.
+    Once data is loaded, refreshes run in the background and the stale data is served meanwhile.
+    """
+    if capacity_data is None:
+        # Nothing to serve yet, so the first load has to block
+        with initial_load_lock:
+            if capacity_data is None:
+                shared = load_shared_cache()
+                if shared is not None:
+                    set_capacity_data(*shared)
+                else:
+                    # Written synchronously: this may run in the gunicorn master, which must
+                    # not start a writer thread that forked workers would inherit mid-write
+                    set_capacity_data(compute_capacity_data(write_in_background=False), datetime.now())
+        return capacity_data
+    
+    is_fresh = (datetime.now() - last_updated).total_seconds() < CACHE_TTL
+    
+    if force_refresh or not is_fresh:
+        # Another worker may already have refreshed the shared cache file
+        shared = None if force_refresh else load_shared_cache()
+        
+        if shared is not None:
+            set_capacity_data(*shared)
+        else:
+            start_background_refresh()
+    
+    return capacity_data
+
+def request_refresh():
+    """
+    Force a background refresh, loading the data first if none has been loaded yet.
+    Returns True if a refresh was started, False if one was already running.
+    """
+    if capacity_data is None:
+        get_capacity_data()
     
-    return render_template('index.html', data=formatted_data)
+    return start_background_refresh()
+
+@app.route('/')
+def index():
+    """
+    Main dashboard page
+    """
+    global rendered_index_html, rendered_index_key
+    
+    data = get_capacity_data()
+    
+    if rendered_index_key != data['last_updated']:
+        rendered_index_html = render_template('index.html', data=formatted_data)
+        rendered_index_key = data['last_updated']
+    
+    return rendered_index_html
 
 @app.route('/api/data')
 def api_data():
@@ -107,21 +369,11 @@ def api_data():
 @app.route('/refresh')
 def refresh_data():
     """
-    Force refresh the data from API
+    Force refresh the data from API in the background
     """
-    data = get_capacity_data(force_refresh=True)
+    started = request_refresh()
     
-    formatted_data = {
-        'accepted_capacity': f"{data['summary']['accepted_capacity']:,.2f}",
-        'connected_capacity': f"{data['summary']['connected_capacity']:,.2f}",
-        'max_export_capacity': f"{data['summary']['max_export_capacity']:,.2f}",
-        'max_import_capacity': f"{data['summary']['max_import_capacity']:,.2f}",
-        'grand_total': f"{data['summary']['grand_total']:,.2f}",
-        'records_count': f"{data['records_count']:,}",
-        'last_updated': data['last_updated']
-    }
-    
-    return render_template('index.html', data=formatted_data, refreshed=True)
+    return render_template('index.html', data=formatted_data, refreshed=True, refresh_started=started)
 
 @app.route('/details')
 def details():
@@ -134,13 +386,14 @@ def details():
 @app.route('/api/refresh', methods=['POST'])
 def api_refresh():
     """
-    API endpoint to refresh data
+    API endpoint to start a background data refresh
     """
-    data = get_capacity_data(force_refresh=True)
+    started = request_refresh()
     return jsonify({
         'status': 'success',
-        'message': 'Data refreshed successfully',
-        'data': data
+        'message': 'Data refresh started' if started else 'A data refresh is already in progress',
+        'refresh_started': started,
+        'data': capacity_data
     })
 
 
@@ -149,19 +402,12 @@ def game():
     """
     Kettle Game - See when Scotland blacks out from kettle usage
     """
-    data = get_capacity_data()
-    
-    # Get current capacity
-    available_capacity = data['summary']['connected_capacity']
-    
-    # Calculate baseline info
-    kettle_power = 3.0  # kW per kettle
-    kettles_to_blackout = math.ceil((available_capacity * 1000) / kettle_power)  # Convert MW to kW
+    get_capacity_data()
     
     return render_template('game.html', 
-                         available_capacity=available_capacity,
-                         kettle_power=kettle_power,
-                         kettles_to_blackout=kettles_to_blackout)
+                         available_capacity=game_constants['available_capacity'],
+                         kettle_power=KETTLE_POWER,
+                         kettles_to_blackout=game_constants['kettles_to_blackout'])
 
 @app.route('/api/game/calculate', methods=['POST'])
 def calculate_blackout():
@@ -171,12 +417,12 @@ def calculate_blackout():
     data = request.json
     kettle_count = data.get('kettle_count', 0)
     
-    game_data = get_capacity_data()
-    available_capacity = game_data['summary']['connected_capacity']
+    get_capacity_data()
+    constants = game_constants
+    available_capacity = constants['available_capacity']
     
     # Game calculations
-    kettle_power = 3.0  # kW per kettle
-    total_kettle_power = (kettle_count * kettle_power) / 1000  # Convert to MW
+    total_kettle_power = (kettle_count * KETTLE_POWER) / 1000  # Convert to MW
     remaining_capacity = available_capacity - total_kettle_power
     blackout_percentage = min(100, max(0, (total_kettle_power / available_capacity) * 100))
     
@@ -202,7 +448,7 @@ def calculate_blackout():
         'blackout_percentage': blackout_percentage,
         'status': status,
         'message': message,
-        'kettles_to_blackout': math.ceil((available_capacity * 1000) / kettle_power)
+        'kettles_to_blackout': constants['kettles_to_blackout']
     })
 
 @app.errorhandler(404)
@@ -214,8 +460,9 @@ def internal_error(error):
     return render_template('500.html'), 500
 
 if __name__ == '__main__':
+    # Development server only; in production run: gunicorn -c gunicorn_conf.py app:app
     # Pre-load data on startup
     print("Pre-loading capacity data...")
     get_capacity_data()
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,32 @@
+"""
+Gunicorn configuration for the Scotland capacity dashboard
+
+Run with:
+    gunicorn -c gunicorn_conf.py app:app
+"""
+from multiprocessing import cpu_count
+
+bind = '0.0.0.0:5000'
+workers = 2 * cpu_count() + 1
+worker_class = 'gthread'
+threads = 8
+
+# Load the app in the master so the capacity cache is shared copy-on-write by the workers
+preload_app = True
+
+def when_ready(server):
+    """
+    Fill the capacity cache in the master before the workers are forked
+    """
+    from app import get_capacity_data
+    
+    server.log.info("Pre-loading capacity data...")
+    get_capacity_data()
+
+def post_fork(server, worker):
+    """
+    Drop HTTP connections inherited from the master so workers don't share sockets
+    """
+    from app import analyzer
+    
+    analyzer.close()
@@ -1,7 +1,35 @@
-import requests
+import numpy as np
 import pandas as pd
 import json
-from typing import Dict, List, Optional
+import orjson
+import re
+from sse_http import SESSION, TIMEOUT
+from typing import Dict, List, Optional, Tuple
+
+SCOTTISH_INDICATORS = [
+    'Scotland', 'SCOTLAND', 'scotland',
+    'Glasgow', 'Edinburgh', 'Aberdeen', 'Dundee', 'Inverness'
+]
+
+SCOTTISH_POSTCODES = ['G', 'EH', 'AB', 'DD', 'IV', 'KY', 'FK']
+
+# Precomputed once at import for the search and filter paths
+_SCOTTISH_TERMS = sorted({indicator.lower() for indicator in SCOTTISH_INDICATORS})
+_SCOTTISH_RE = re.compile('|'.join(_SCOTTISH_TERMS), re.IGNORECASE)
+_SCOTTISH_POSTCODES = frozenset(SCOTTISH_POSTCODES)
+_POSTCODE_AREA_RE = re.compile(r'^([A-Z]{1,2})(?![A-Z])')
+
+LOCATION_FIELDS = ['Country', 'County', 'town__city', 'Postcode']
+
+CAPACITY_FIELDS = {
+    'accepted_registered_capacity': 'accepted_to_connect_registered_capacity__mw_',
+    'connected_registered_capacity': 'already_connected_registered_capacity__mw_',
+    'maximum_export_capacity': 'maximum_export_capacity__mw_',
+    'maximum_import_capacity': 'maximum_import_capacity__mw_'
+}
+
+# CKAN datastore column types that hold numbers
+CKAN_NUMERIC_TYPES = {'int', 'int4', 'int8', 'float4', 'float8', 'numeric'}
 
 class SSEScotlandCapacityAnalyzer:
     """
@@ -10,62 +38,165 @@ class SSEScotlandCapacityAnalyzer:
     
     def __init__(self):
         self.base_url = 'https://ckan-prod.sse.datopian.com/api/3/action/datastore_search'
+        self.sql_url = 'https://ckan-prod.sse.datopian.com/api/3/action/datastore_search_sql'
         self.resource_id = 'd258bd7b-22db-4d32-9450-b3783591b66d'
+        # Shared keep-alive connection pool with retries for every call to the CKAN host
+        self.session = SESSION
+        
+    def close(self):
+        """
+        Close the pooled HTTP connections
+        """
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def _search(self, params: Dict) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Run a single datastore_search query and return its records and field schema
+        """
+        response = self.session.get(self.base_url, params=params, timeout=TIMEOUT)
+        data = orjson.loads(response.content)
+        
+        if data.get('success') and data['result']['records']:
+            return data['result']['records'], data['result'].get('fields', [])
+        return [], []
+    
+    @staticmethod
+    def _build_dataframe(records: List[Dict], schema: Dict[str, str]) -> pd.DataFrame:
+        """
+        Build a DataFrame with the columns and numeric types given by the CKAN field schema
+        """
+        if not schema:
+            return pd.DataFrame(records)
+        
+        df = pd.DataFrame.from_records(records, columns=list(schema))
+        
+        numeric_fields = [field_id for field_id, field_type in schema.items() if field_type in CKAN_NUMERIC_TYPES]
+        if numeric_fields:
+            df[numeric_fields] = df[numeric_fields].apply(pd.to_numeric, errors='coerce')
+        
+        return df
+    
+    def build_scotland_totals_sql(self) -> str:
+        """
+        Build a datastore_search_sql query that filters and totals Scotland capacity server-side
+        """
+        indicators = '|'.join(_SCOTTISH_TERMS)
+        postcodes = '|'.join(SCOTTISH_POSTCODES)
+        
+        location_checks = [f"\"{field}\"::text ~* '{indicators}'" for field in LOCATION_FIELDS]
+        location_checks.append(f"UPPER(\"Postcode\"::text) ~ '^({postcodes})([^A-Z]|$)'")
+        
+        # Text that isn't a decimal number, optionally signed and with an exponent, becomes NULL
+        # as with pd.to_numeric(errors='coerce'); unlike pandas, 'inf' and 'nan' are NULL too
+        numeric_columns = [
+            f"CASE WHEN \"{field_id}\"::text ~ '^\\s*[-+]?([0-9]+\\.?[0-9]*|\\.[0-9]+)([eE][-+]?[0-9]+)?\\s*$' "
+            f"THEN \"{field_id}\"::text::numeric END AS {name}"
+            for name, field_id in CAPACITY_FIELDS.items()
+        ]
+        
+        aggregates = ['COUNT(*) AS records_count']
+        for name in CAPACITY_FIELDS:
+            aggregates.extend([
+                f"SUM({name}) AS {name}_sum",
+                f"COUNT({name}) AS {name}_count",
+                f"AVG({name}) AS {name}_mean",
+                f"MIN({name}) AS {name}_min",
+                f"MAX({name}) AS {name}_max"
+            ])
         
+        return (
+            f"SELECT {', '.join(aggregates)} FROM ("
+            f"SELECT {', '.join(numeric_columns)} FROM \"{self.resource_id}\" "
+            f"WHERE {' OR '.join(location_checks)}"
+            f") AS scotland"
+        )
+    
+    def fetch_scotland_totals(self) -> Optional[Dict]:
+        """
+        Fetch Scotland capacity totals aggregated by the CKAN SQL endpoint.
+        Returns None if the endpoint fails or finds no Scottish records.
+        """
+        print("Fetching Scotland totals from SSE SQL API...")
+        
+        try:
+            response = self.session.post(self.sql_url, json={'sql': self.build_scotland_totals_sql()}, timeout=TIMEOUT)
+            data = orjson.loads(response.content)
+            
+            if not data.get('success') or not data['result']['records']:
+                print(f"SQL API returned no results: {data.get('error')}")
+                return None
+            
+            row = data['result']['records'][0]
+        except Exception as e:
+            print(f"Error fetching totals from SQL API: {e}")
+            return None
+        
+        records_count = int(row['records_count'] or 0)
+        if records_count == 0:
+            print("No Scotland records found by SQL API")
+            return None
+        
+        totals = {}
+        for capacity_name in CAPACITY_FIELDS:
+            count_records = int(row[f'{capacity_name}_count'] or 0)
+            
+            totals[capacity_name] = {
+                'total_mw': float(row[f'{capacity_name}_sum'] or 0),
+                'count_records': count_records,
+                'average_mw': float(row[f'{capacity_name}_mean']) if count_records > 0 else 0,
+                'min_mw': float(row[f'{capacity_name}_min']) if count_records > 0 else 0,
+                'max_mw': float(row[f'{capacity_name}_max']) if count_records > 0 else 0
+            }
+        
+        print(f"Scotland records totalled by SQL API: {records_count}")
+        return {'totals': totals, 'records_count': records_count}
+    
     def fetch_scotland_data(self, limit: int = 32000) -> pd.DataFrame:
         """
         Fetch data for Scotland
         """
         print("Fetching Scotland data from SSE API...")
         
-        # Try multiple approaches to get data
-        all_records = []
+        records, fields = [], []
         
-        # Approach 1: Get general data
-        print("Getting general data sample...")
-        general_params = {
+        # Approach 1: One full-text search for any Scottish term.
+        # plain=false makes CKAN use to_tsquery, so '|' means OR
+        search_params = {
             'resource_id': self.resource_id,
-            'limit': min(limit, 1000)
+            'q': ' | '.join(_SCOTTISH_TERMS),
+            'plain': 'false',
+            'limit': limit
         }
         
         try:
-            response = requests.get(self.base_url, params=general_params)
-            data = response.json()
-            
-            if data.get('success') and data['result']['records']:
-                records = data['result']['records']
-                all_records.extend(records)
-                print(f"Retrieved {len(records)} general records")
+            records, fields = self._search(search_params)
+            print(f"Found {len(records)} records for Scottish terms")
         except Exception as e:
-            print(f"Error fetching general data: {e}")
+            print(f"Error searching for Scottish terms: {e}")
         
-        # Approach 2: Try Scottish search terms
-        scottish_terms = ["Scotland", "Glasgow", "Edinburgh", "Aberdeen"]
-        
-        for term in scottish_terms:
+        # Approach 2: Fall back to a general data sample
+        if not records:
+            print("Getting general data sample...")
+            general_params = {
+                'resource_id': self.resource_id,
+                'limit': min(limit, 1000)
+            }
+            
             try:
-                params = {
-                    'resource_id': self.resource_id,
-                    'q': term,
-                    'limit': 500
-                }
-                
-                response = requests.get(self.base_url, params=params)
-                data = response.json()
-                
-                if data.get('success') and data['result']['records']:
-                    records = data['result']['records']
-                    # Add only new records
-                    for record in records:
-                        if record not in all_records:
-                            all_records.append(record)
-                    print(f"Found {len(records)} records for '{term}'")
-                    
+                records, fields = self._search(general_params)
+                print(f"Retrieved {len(records)} general records")
             except Exception as e:
-                print(f"Error searching for {term}: {e}")
+                print(f"Error fetching general data: {e}")
         
-        if all_records:
-            df = pd.DataFrame(all_records)
+        if records:
+            schema = {field['id']: field['type'] for field in fields}
+            df = self._build_dataframe(records, schema)
             print(f"Total records retrieved: {len(df)}")
             return df
         else:
@@ -81,32 +212,23 @@ class SSEScotlandCapacityAnalyzer:
             
         print("Filtering for Scotland data...")
         
-        scottish_indicators = [
-            'Scotland', 'SCOTLAND', 'scotland',
-            'Glasgow', 'Edinburgh', 'Aberdeen', 'Dundee', 'Inverness'
-        ]
-        
-        scottish_postcodes = ['G', 'EH', 'AB', 'DD', 'IV', 'KY', 'FK']
-        
-        scotland_mask = pd.Series([False] * len(df))
+        scotland_mask = np.zeros(len(df), dtype=bool)
         
-        # Check location fields
-        location_fields = ['Country', 'County', 'town__city', 'Postcode']
+        # Check postcodes first: the area is one or two leading letters not followed by
+        # another letter, the same rule build_scotland_totals_sql applies server-side
+        if 'Postcode' in df.columns:
+            postcode_area = df['Postcode'].fillna('').astype(str).str.upper().str.extract(_POSTCODE_AREA_RE, expand=False)
+            scotland_mask = postcode_area.isin(_SCOTTISH_POSTCODES).to_numpy(dtype=bool, copy=True)
         
-        for field in location_fields:
-            if field in df.columns:
-                field_mask = df[field].astype(str).str.contains(
-                    '|'.join(scottish_indicators), 
-                    case=False, 
-                    na=False
-                )
-                scotland_mask = scotland_mask | field_mask
+        # Check location fields only for rows without a Scottish postcode,
+        # joined into one string per row so the regex runs once
+        present_fields = [field for field in LOCATION_FIELDS if field in df.columns]
+        unmatched = ~scotland_mask
         
-        # Check postcodes
-        if 'Postcode' in df.columns:
-            postcode_mask = df['Postcode'].astype(str).str.extract(r'^([A-Z]+)', expand=False)
-            postcode_mask = postcode_mask.isin(scottish_postcodes)
-            scotland_mask = scotland_mask | postcode_mask
+        if present_fields and unmatched.any():
+            locations = df.loc[unmatched, present_fields].fillna('').astype(str)
+            combined = locations.iloc[:, 0].str.cat(locations.iloc[:, 1:], sep=' ')
+            scotland_mask[unmatched] = combined.str.contains(_SCOTTISH_RE, na=False).to_numpy(dtype=bool)
         
         scotland_df = df[scotland_mask].copy()
         print(f"Scotland records after filtering: {len(scotland_df)}")
@@ -119,27 +241,25 @@ class SSEScotlandCapacityAnalyzer:
         """
         print("Calculating capacity totals...")
         
-        capacity_fields = {
-            'accepted_registered_capacity': 'accepted_to_connect_registered_capacity__mw_',
-            'connected_registered_capacity': 'already_connected_registered_capacity__mw_',
-            'maximum_export_capacity': 'maximum_export_capacity__mw_',
-            'maximum_import_capacity': 'maximum_import_capacity__mw_'
-        }
+        # Convert and aggregate every present field in one pass
+        present_fields = [field_id for field_id in CAPACITY_FIELDS.values() if field_id in df.columns]
+        if present_fields:
+            numeric = df[present_fields].apply(pd.to_numeric, errors='coerce')
+            stats = numeric.agg(['sum', 'count', 'mean', 'min', 'max'])
         
         totals = {}
         
-        for capacity_name, field_id in capacity_fields.items():
+        for capacity_name, field_id in CAPACITY_FIELDS.items():
             if field_id in df.columns:
-                capacity_series = pd.to_numeric(df[field_id], errors='coerce')
-                valid_capacities = capacity_series.dropna()
-                total_capacity = valid_capacities.sum()
+                field_stats = stats[field_id]
+                count_records = int(field_stats['count'])
                 
                 totals[capacity_name] = {
-                    'total_mw': total_capacity,
-                    'count_records': len(valid_capacities),
-                    'average_mw': total_capacity / len(valid_capacities) if len(valid_capacities) > 0 else 0,
-                    'min_mw': valid_capacities.min() if len(valid_capacities) > 0 else 0,
-                    'max_mw': valid_capacities.max() if len(valid_capacities) > 0 else 0
+                    'total_mw': float(field_stats['sum']),
+                    'count_records': count_records,
+                    'average_mw': float(field_stats['mean']) if count_records > 0 else 0,
+                    'min_mw': float(field_stats['min']) if count_records > 0 else 0,
+                    'max_mw': float(field_stats['max']) if count_records > 0 else 0
                 }
             else:
                 totals[capacity_name] = {'total_mw': 0, 'count_records': 0, 'average_mw': 0}
@@ -0,0 +1,22 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# (connect, read) timeout in seconds for every call made through SESSION
+TIMEOUT = (3.05, 10)
+
+def configure_session(session: requests.Session) -> requests.Session:
+    """
+    Mount a pooled adapter that retries transient gateway errors with backoff
+    """
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Shared keep-alive session for all SSE / SSEN API calls
+SESSION = configure_session(requests.Session())
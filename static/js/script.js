@@ -8,7 +8,9 @@ function refreshData() {
     .then(response => response.json())
     .then(data => {
         if (data.status === 'success') {
-            location.reload();
+            // The refresh runs in the background, so wait for new figures before reloading
+            console.log(data.message);
+            waitForNewData(data.data.last_updated, 30);
         } else {
             alert('Error refreshing data');
         }
@@ -19,6 +21,30 @@ function refreshData() {
     });
 }
 
+function waitForNewData(lastUpdated, attemptsLeft) {
+    // Poll until last_updated changes, reloading anyway once the attempts run out
+    if (attemptsLeft <= 0) {
+        location.reload();
+        return;
+    }
+
+    setTimeout(() => {
+        fetch('/api/data')
+        .then(response => response.json())
+        .then(data => {
+            if (data.last_updated !== lastUpdated) {
+                location.reload();
+            } else {
+                waitForNewData(lastUpdated, attemptsLeft - 1);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            waitForNewData(lastUpdated, attemptsLeft - 1);
+        });
+    }, 2000);
+}
+
 // Auto-refresh every 5 minutes
 setTimeout(() => {
     console.log('Auto-refreshing data...');
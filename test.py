@@ -1,4 +1,5 @@
 import requests
+from sse_http import SESSION, TIMEOUT
 import pandas as pd
 import io
 
@@ -15,7 +16,7 @@ def get_scotland_capacity_data():
     print(f"Fetching metadata from {metadata_api_url}...")
     
     try:
-        response = requests.get(metadata_api_url)
+        response = SESSION.get(metadata_api_url, timeout=TIMEOUT)
         response.raise_for_status()  # Raise an error for bad status codes
         dataset_info = response.json()
     except requests.exceptions.RequestException as e:
@@ -51,7 +52,7 @@ def get_scotland_capacity_data():
     # 3. --- Download the CSV data ---
     try:
         print("Downloading data...")
-        data_response = requests.get(csv_url)
+        data_response = SESSION.get(csv_url, timeout=TIMEOUT)
         data_response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"Error downloading data file: {e}")
@@ -1,6 +1,6 @@
 import json
 import pandas as pd
-import requests
+from sse_http import SESSION, TIMEOUT
 from io import BytesIO
 
 # Load your JSON data
@@ -32,7 +32,7 @@ if latest_file:
     try:
         # Download and analyze the file
         print("\n⏬ Downloading file...")
-        response = requests.get(latest_file['url'])
+        response = SESSION.get(latest_file['url'], timeout=TIMEOUT)
         response.raise_for_status()
         
         # Read Excel file
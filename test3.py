@@ -1,8 +1,62 @@
-import requests
+import requests_cache
+from sse_http import TIMEOUT, configure_session
 import pandas as pd
 import json
+import numpy as np
+import orjson
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
 
+# Cap on in-flight API requests so the SSE API isn't hammered
+MAX_CONCURRENT_REQUESTS = 8
+
+CAPACITY_FIELDS = {
+    'accepted_registered_capacity': 'accepted_to_connect_registered_capacity__mw_',
+    'connected_registered_capacity': 'already_connected_registered_capacity__mw_',
+    'maximum_export_capacity': 'maximum_export_capacity__mw_',
+    'maximum_import_capacity': 'maximum_import_capacity__mw_',
+    'energy_tech_1_capacity': 'energy_source___energy_conversion_technology_1___registered_',
+    'energy_tech_2_capacity': 'energy_source___energy_conversion_technology_2___registered_',
+    'energy_tech_3_capacity': 'energy_source___energy_conversion_technology_3___registered_'
+}
+
+NUMERIC_FIELDS = list(CAPACITY_FIELDS.values())
+
+CATEGORICAL_FIELDS = ['Connection Status', 'Country', 'County', 'town__city']
+
+LOCATION_FIELDS = ['Country', 'County', 'town__city', 'Address Line 1', 'Address Line 2', 'Postcode']
+
+RELEVANT_COLUMNS = [
+    'Customer Name', 'Customer Site', 'town__city', 'County', 'Postcode', 'Country',
+    'Connection Status', 'accepted_to_connect_registered_capacity__mw_',
+    'already_connected_registered_capacity__mw_', 'maximum_export_capacity__mw_',
+    'maximum_import_capacity__mw_', 'Date Connected', 'Date Accepted'
+]
+
+# Every column the analysis reads; _id is needed to deduplicate records
+REQUIRED_FIELDS = list(dict.fromkeys(
+    ['_id'] + list(CAPACITY_FIELDS.values()) + LOCATION_FIELDS + RELEVANT_COLUMNS
+))
+
+def build_postcode_lut(postcode_areas: List[str]) -> np.ndarray:
+    """
+    Build a 256x256 table that is True where the first two postcode characters
+    start one of the given areas. The area is the leading capital letters, so a
+    one-letter area only matches when the next character is not A-Z.
+    """
+    lut = np.zeros((256, 256), dtype=bool)
+    not_letters = [code for code in range(256) if not 'A' <= chr(code) <= 'Z']
+    
+    for area in postcode_areas:
+        if len(area) == 1:
+            lut[ord(area), not_letters] = True
+        else:
+            lut[ord(area[0]), ord(area[1])] = True
+    
+    return lut
+
 class SSEScotlandCapacityAnalyzer:
     """
     A class to extract and sum capacity figures from SSE Scotland data
@@ -11,12 +65,94 @@ class SSEScotlandCapacityAnalyzer:
     def __init__(self):
         self.base_url = 'https://ckan-prod.sse.datopian.com/api/3/action/datastore_search'
         self.resource_id = 'd258bd7b-22db-4d32-9450-b3783591b66d'
+        # Responses are cached on disk, so reruns within an hour skip the API
+        self.session = configure_session(requests_cache.CachedSession('sse_cache', expire_after=3600))
+        self.fields = None
+        # Responses already fetched, keyed on the request parameters
+        self.responses = {}
+        
+    def _load_fields(self):
+        """
+        Look up which REQUIRED_FIELDS the resource has, so searches only return those columns
+        """
+        if self.fields is not None:
+            return
+        
+        try:
+            params = {'resource_id': self.resource_id, 'limit': 0}
+            response = self.session.get(self.base_url, params=params, timeout=TIMEOUT)
+            data = orjson.loads(response.content)
+            available = {field['id'] for field in data['result']['fields']}
+            self.fields = ','.join(field for field in REQUIRED_FIELDS if field in available)
+        except Exception as e:
+            print(f"Error fetching field list, requesting all columns: {e}")
+            self.fields = ''
+    
+    def _query(self, params: Dict) -> Dict:
+        """
+        Run a single datastore_search query and return its result, or {} if it failed
+        """
+        if self.fields:
+            params = {**params, 'fields': self.fields}
+        
+        key = tuple(sorted(params.items()))
+        if key in self.responses:
+            return self.responses[key]
+        
+        response = self.session.get(self.base_url, params=params, timeout=TIMEOUT)
+        data = orjson.loads(response.content)
         
+        result = data['result'] if data.get('success') else {}
+        
+        self.responses[key] = result
+        return result
+    
+    def _search(self, params: Dict) -> List[Dict]:
+        """
+        Run a single datastore_search query and return its records
+        """
+        return self._query(params).get('records') or []
+    
+    @staticmethod
+    def _add_new_records(records: List[Dict], all_records: List[Dict], seen_ids: set):
+        """
+        Append records not seen before, keyed on the CKAN datastore _id
+        """
+        for record in records:
+            if '_id' in record:
+                record_id = record['_id']
+            else:
+                record_id = tuple(sorted(record.items()))
+            
+            if record_id not in seen_ids:
+                seen_ids.add(record_id)
+                all_records.append(record)
+    
+    @staticmethod
+    def _build_dataframe(records: List[Dict]) -> pd.DataFrame:
+        """
+        Build a DataFrame with the capacity columns converted to float once, up front,
+        and repeated text columns stored as categories
+        """
+        df = pd.DataFrame.from_records(records)
+        
+        numeric_fields = [field for field in NUMERIC_FIELDS if field in df.columns]
+        if numeric_fields:
+            df[numeric_fields] = df[numeric_fields].apply(pd.to_numeric, errors='coerce')
+        
+        # Low-cardinality text columns are stored as categories, so counting hashes codes not strings
+        for field in CATEGORICAL_FIELDS:
+            if field in df.columns:
+                df[field] = df[field].astype('category')
+        
+        return df
+    
     def fetch_scotland_data(self, limit: int = 32000) -> pd.DataFrame:
         """
         Fetch data for Scotland by searching for Scottish locations and postcodes
         """
         print("Fetching Scotland data from SSE API...")
+        self._load_fields()
         
         # Scottish-related search terms
         scottish_terms = [
@@ -38,68 +174,85 @@ class SSEScotlandCapacityAnalyzer:
         ]
         
         all_records = []
+        seen_ids = set()
+        search_limit = 1000
+        
+        general_params = {
+            'resource_id': self.resource_id,
+            'limit': min(limit, 1000)
+        }
         
-        for term in scottish_terms:
-            print(f"Searching for: {term}")
-            params = {
-                'resource_id': self.resource_id,
-                'q': term,
-                'limit': 1000
-            }
+        # The searches are network-bound, so run them concurrently and merge in the original order
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            term_futures = {}
+            for term in scottish_terms:
+                print(f"Searching for: {term}")
+                params = {
+                    'resource_id': self.resource_id,
+                    'q': term,
+                    'limit': search_limit
+                }
+                term_futures[term] = executor.submit(self._search, params)
             
-            try:
-                response = requests.get(self.base_url, params=params)
-                data = response.json()
+            # Also get a sample without filters to ensure we get data
+            print("Getting general sample...")
+            general_future = executor.submit(self._search, general_params)
+            
+            # Also search in specific Scottish fields, but only when the full-text
+            # search hit its limit and so may have missed matching records
+            term_records = {}
+            field_futures = {}
+            for term in scottish_terms:
+                try:
+                    term_records[term] = term_futures[term].result()
+                except Exception as e:
+                    print(f"Error searching for {term}: {e}")
+                    term_records[term] = []
+                    continue
                 
-                if data.get('success') and data['result']['records']:
-                    records = data['result']['records']
-                    all_records.extend(records)
-                    print(f"  Found {len(records)} records for '{term}'")
-                    
-                    # Also search in specific Scottish fields
+                if len(term_records[term]) >= search_limit:
                     for field in ['Country', 'County', 'town__city']:
                         field_params = {
                             'resource_id': self.resource_id,
                             'filters': json.dumps({field: term}),
-                            'limit': 1000
+                            'limit': search_limit
                         }
-                        
-                        field_response = requests.get(self.base_url, params=field_params)
-                        field_data = field_response.json()
-                        
-                        if field_data.get('success') and field_data['result']['records']:
-                            field_records = field_data['result']['records']
-                            # Avoid duplicates by checking if record already exists
-                            for record in field_records:
-                                if record not in all_records:
-                                    all_records.append(record)
-                            print(f"    Found {len(field_records)} additional records in {field}")
-                            
-            except Exception as e:
-                print(f"Error searching for {term}: {e}")
-        
-        # Also get a sample without filters to ensure we get data
-        print("Getting general sample...")
-        general_params = {
-            'resource_id': self.resource_id,
-            'limit': min(limit, 1000)
-        }
-        
-        try:
-            general_response = requests.get(self.base_url, params=general_params)
-            general_data = general_response.json()
+                        field_futures[(term, field)] = executor.submit(self._search, field_params)
             
-            if general_data.get('success') and general_data['result']['records']:
-                general_records = general_data['result']['records']
-                for record in general_records:
-                    if record not in all_records:
-                        all_records.append(record)
-                print(f"Added {len(general_records)} general records")
-        except Exception as e:
-            print(f"Error fetching general data: {e}")
+            for term in scottish_terms:
+                records = term_records[term]
+                if not records:
+                    continue
+                
+                self._add_new_records(records, all_records, seen_ids)
+                print(f"  Found {len(records)} records for '{term}'")
+                
+                for field in ['Country', 'County', 'town__city']:
+                    if (term, field) not in field_futures:
+                        continue
+                    
+                    try:
+                        field_records = field_futures[(term, field)].result()
+                    except Exception as e:
+                        print(f"Error searching for {term} in {field}: {e}")
+                        continue
+                    
+                    if field_records:
+                        # Avoid duplicates by checking if record already exists
+                        self._add_new_records(field_records, all_records, seen_ids)
+                        print(f"    Found {len(field_records)} additional records in {field}")
+            
+            try:
+                general_records = general_future.result()
+                
+                if general_records:
+                    self._add_new_records(general_records, all_records, seen_ids)
+                    print(f"Added {len(general_records)} general records")
+            except Exception as e:
+                print(f"Error fetching general data: {e}")
         
         if all_records:
-            df = pd.DataFrame(all_records)
+            df = self._build_dataframe(all_records)
             print(f"\nTotal Scotland-related records found: {len(df)}")
             return df
         else:
@@ -111,39 +264,61 @@ class SSEScotlandCapacityAnalyzer:
         Fetch all data and filter for Scotland later
         """
         print("Fetching all available data...")
+        self._load_fields()
         
         all_records = []
-        offset = 0
         batch_size = 1000
         
-        while len(all_records) < limit:
-            params = {
-                'resource_id': self.resource_id,
-                'limit': batch_size,
-                'offset': offset
-            }
+        # The first page tells us the total, so the remaining pages can be requested together
+        first_params = {
+            'resource_id': self.resource_id,
+            'limit': batch_size,
+            'offset': 0
+        }
+        
+        try:
+            first_page = self._query(first_params)
+        except Exception as e:
+            print(f"Error fetching data at offset 0: {e}")
+            first_page = {}
+        
+        records = first_page.get('records') or []
+        all_records.extend(records)
+        if records:
+            print(f"Fetched {len(records)} records (total: {len(all_records)})")
+        
+        if len(records) == batch_size:
+            total = first_page.get('total', limit)
+            offsets = range(batch_size, min(total, limit), batch_size)
             
-            try:
-                response = requests.get(self.base_url, params=params)
-                data = response.json()
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+                futures = []
+                for offset in offsets:
+                    params = {
+                        'resource_id': self.resource_id,
+                        'limit': batch_size,
+                        'offset': offset
+                    }
+                    futures.append((offset, executor.submit(self._search, params)))
                 
-                if not data.get('success') or not data['result']['records']:
-                    break
+                # Concatenate in offset order, stopping at the first failed or empty page
+                for offset, future in futures:
+                    try:
+                        records = future.result()
+                    except Exception as e:
+                        print(f"Error fetching data at offset {offset}: {e}")
+                        break
                     
-                records = data['result']['records']
-                all_records.extend(records)
-                offset += batch_size
-                
-                print(f"Fetched {len(records)} records (total: {len(all_records)})")
-                
-                if len(records) < batch_size:
-                    break
+                    if not records:
+                        break
                     
-            except Exception as e:
-                print(f"Error fetching data at offset {offset}: {e}")
-                break
+                    all_records.extend(records)
+                    print(f"Fetched {len(records)} records (total: {len(all_records)})")
+                    
+                    if len(records) < batch_size:
+                        break
         
-        df = pd.DataFrame(all_records)
+        df = self._build_dataframe(all_records)
         print(f"\nTotal records fetched: {len(df)}")
         return df
     
@@ -162,29 +337,50 @@ class SSEScotlandCapacityAnalyzer:
         ]
         
         # Scottish postcode areas
-        scottish_postcodes = ['G', 'EH', 'AB', 'DD', 'IV', 'KY', 'FK', 'KW', 'PA', 'PH', 'TD', 'DG', 'ML', 'KA']
+        scottish_postcodes = ['G', 'EH', 'AB', 'DD', 'IV', 'KY', 'FK', 'KW', 'PA', 'PH', 'TD', 'DG', 'ML', 'KA', 'HS', 'ZE']
         
-        scotland_mask = pd.Series([False] * len(df))
+        scotland_mask = np.zeros(len(df), dtype=bool)
+        # Rows with a real non-Scottish postcode skip the text search below
+        candidates = np.ones(len(df), dtype=bool)
         
-        # Check various fields for Scottish indicators
-        location_fields = ['Country', 'County', 'town__city', 'Address Line 1', 'Address Line 2', 'Postcode']
+        # The indicators are plain literals, so lowercase values and match without case folding
+        indicators_lower = sorted({indicator.lower() for indicator in scottish_indicators})
+        indicator_pattern = re.compile('|'.join(re.escape(indicator) for indicator in indicators_lower))
         
-        for field in location_fields:
-            if field in df.columns:
-                field_mask = df[field].astype(str).str.contains(
-                    '|'.join(scottish_indicators), 
-                    case=False, 
-                    na=False
-                )
-                scotland_mask = scotland_mask | field_mask
-                print(f"  Found {field_mask.sum()} records in {field}")
-        
-        # Check for Scottish postcodes
+        # Check for Scottish postcodes with one table lookup on the first two characters
         if 'Postcode' in df.columns:
-            postcode_mask = df['Postcode'].astype(str).str.extract(r'^([A-Z]+)', expand=False)
-            postcode_mask = postcode_mask.isin(scottish_postcodes)
-            scotland_mask = scotland_mask | postcode_mask
+            postcode_lut = build_postcode_lut(scottish_postcodes)
+            chars = df['Postcode'].fillna('').astype(str).to_numpy().astype('U2').view(np.uint32).reshape(-1, 2)
+            chars = np.minimum(chars, 255)
+            postcode_mask = postcode_lut[chars[:, 0], chars[:, 1]]
+            np.logical_or(scotland_mask, postcode_mask, out=scotland_mask)
             print(f"  Found {postcode_mask.sum()} records with Scottish postcodes")
+            
+            # Only a well-formed outward code whose first letter starts no Scottish area rules
+            # a row out; blank, placeholder or malformed postcodes count as missing
+            outward = df['Postcode'].fillna('').astype(str).str.strip().str.upper().str.extract(
+                r'^([A-Z]{1,2})[0-9]', expand=False
+            )
+            ruled_out = outward.notna() & ~outward.str[0].isin({area[0] for area in scottish_postcodes})
+            candidates = ~ruled_out.to_numpy(dtype=bool)
+        
+        # Check various fields for Scottish indicators. Location columns repeat a
+        # small set of values, so factorize all of them together, match each
+        # distinct value once in a single scan and map back by code
+        present_fields = [field for field in LOCATION_FIELDS if field in df.columns]
+        to_check = candidates & ~scotland_mask
+        
+        if present_fields and to_check.any():
+            locations = df[present_fields].to_numpy(dtype=object)[to_check]
+            codes, uniques = pd.factorize(locations.ravel())
+            unique_mask = pd.Series(uniques).astype(str).str.lower().str.contains(indicator_pattern).to_numpy(dtype=bool)
+            # Missing values get code -1, which picks up the trailing False
+            field_masks = np.append(unique_mask, False)[codes].reshape(locations.shape)
+            
+            for i, field in enumerate(present_fields):
+                print(f"  Found {field_masks[:, i].sum()} more records in {field}")
+            
+            scotland_mask[to_check] = field_masks.any(axis=1)
         
         scotland_df = df[scotland_mask].copy()
         print(f"\nTotal Scotland records after filtering: {len(scotland_df)}")
@@ -195,53 +391,51 @@ class SSEScotlandCapacityAnalyzer:
         """
         Calculate total capacity figures for Scotland
         """
-        print("\n=== CALCULATING SCOTLAND CAPACITY TOTALS ===")
-        
-        capacity_fields = {
-            'accepted_registered_capacity': 'accepted_to_connect_registered_capacity__mw_',
-            'connected_registered_capacity': 'already_connected_registered_capacity__mw_',
-            'maximum_export_capacity': 'maximum_export_capacity__mw_',
-            'maximum_import_capacity': 'maximum_import_capacity__mw_',
-            'energy_tech_1_capacity': 'energy_source___energy_conversion_technology_1___registered_',
-            'energy_tech_2_capacity': 'energy_source___energy_conversion_technology_2___registered_',
-            'energy_tech_3_capacity': 'energy_source___energy_conversion_technology_3___registered_'
-        }
+        # Collect the report and write it in one go rather than a print per line
+        lines = ["\n=== CALCULATING SCOTLAND CAPACITY TOTALS ==="]
+        
+        # Convert and aggregate every present field in one pass
+        present_fields = [field_id for field_id in CAPACITY_FIELDS.values() if field_id in df.columns]
+        if present_fields:
+            numeric = df[present_fields].apply(pd.to_numeric, errors='coerce')
+            stats = numeric.agg(['sum', 'count', 'min', 'max', 'mean'])
         
         totals = {}
         
-        for capacity_name, field_id in capacity_fields.items():
+        for capacity_name, field_id in CAPACITY_FIELDS.items():
             if field_id in df.columns:
-                # Convert to numeric, handling non-numeric values
-                capacity_series = pd.to_numeric(df[field_id], errors='coerce')
-                
-                # Remove NaN values
-                valid_capacities = capacity_series.dropna()
+                field_stats = stats[field_id]
                 
-                total_capacity = valid_capacities.sum()
-                count_records = len(valid_capacities)
+                total_capacity = float(field_stats['sum'])
+                count_records = int(field_stats['count'])
+                average_capacity = float(field_stats['mean']) if count_records > 0 else 0
+                min_capacity = float(field_stats['min']) if count_records > 0 else 0
+                max_capacity = float(field_stats['max']) if count_records > 0 else 0
                 
                 totals[capacity_name] = {
                     'total_mw': total_capacity,
                     'count_records': count_records,
-                    'average_mw': total_capacity / count_records if count_records > 0 else 0,
-                    'min_mw': valid_capacities.min() if count_records > 0 else 0,
-                    'max_mw': valid_capacities.max() if count_records > 0 else 0
+                    'average_mw': average_capacity,
+                    'min_mw': min_capacity,
+                    'max_mw': max_capacity
                 }
                 
-                print(f"\n{capacity_name.replace('_', ' ').title()}:")
-                print(f"  Total: {total_capacity:,.2f} MW")
-                print(f"  Records with data: {count_records}")
-                print(f"  Average: {total_capacity / count_records:,.2f} MW" if count_records > 0 else "  Average: N/A")
-                print(f"  Range: {valid_capacities.min():.2f} - {valid_capacities.max():.2f} MW" if count_records > 0 else "  Range: N/A")
+                lines.append(f"\n{capacity_name.replace('_', ' ').title()}:")
+                lines.append(f"  Total: {total_capacity:,.2f} MW")
+                lines.append(f"  Records with data: {count_records}")
+                lines.append(f"  Average: {average_capacity:,.2f} MW" if count_records > 0 else "  Average: N/A")
+                lines.append(f"  Range: {min_capacity:.2f} - {max_capacity:.2f} MW" if count_records > 0 else "  Range: N/A")
             else:
-                print(f"\n{capacity_name.replace('_', ' ').title()}: Field not found")
+                lines.append(f"\n{capacity_name.replace('_', ' ').title()}: Field not found")
                 totals[capacity_name] = {'total_mw': 0, 'count_records': 0, 'average_mw': 0}
         
         # Calculate grand total of all capacities
         grand_total = sum(totals[cap]['total_mw'] for cap in totals)
-        print(f"\n{'='*50}")
-        print(f"GRAND TOTAL CAPACITY: {grand_total:,.2f} MW")
-        print(f"{'='*50}")
+        lines.append(f"\n{'='*50}")
+        lines.append(f"GRAND TOTAL CAPACITY: {grand_total:,.2f} MW")
+        lines.append(f"{'='*50}")
+        
+        sys.stdout.write('\n'.join(lines) + '\n')
         
         return totals
     
@@ -252,28 +446,25 @@ class SSEScotlandCapacityAnalyzer:
         if 'Connection Status' in df.columns:
             print(f"\n=== CONNECTION STATUS DISTRIBUTION ===")
             status_counts = df['Connection Status'].value_counts()
+            # Categories left over from rows filtered out earlier have a zero count
+            status_counts = status_counts[status_counts > 0]
             for status, count in status_counts.items():
                 percentage = (count / len(df)) * 100
                 print(f"  {status}: {count} records ({percentage:.1f}%)")
     
     def export_scotland_data(self, df: pd.DataFrame, filename: str = "scotland_capacity_data.csv"):
         """
-        Export Scotland data to CSV
+        Export Scotland data to CSV, or to zstd-compressed Parquet if filename ends in .parquet
         """
         if not df.empty:
-            # Select relevant columns
-            relevant_columns = [
-                'Customer Name', 'Customer Site', 'town__city', 'County', 'Postcode', 'Country',
-                'Connection Status', 'accepted_to_connect_registered_capacity__mw_',
-                'already_connected_registered_capacity__mw_', 'maximum_export_capacity__mw_',
-                'maximum_import_capacity__mw_', 'Date Connected', 'Date Accepted'
-            ]
-            
-            # Filter to available columns
-            available_columns = [col for col in relevant_columns if col in df.columns]
+            # Filter relevant columns to available columns
+            available_columns = [col for col in RELEVANT_COLUMNS if col in df.columns]
             export_df = df[available_columns]
             
-            export_df.to_csv(filename, index=False)
+            if filename.endswith('.parquet'):
+                export_df.to_parquet(filename, index=False, compression='zstd')
+            else:
+                export_df.to_csv(filename, index=False)
             print(f"\nScotland data exported to {filename}")
             print(f"Exported {len(export_df)} records with {len(available_columns)} columns")
         else:
@@ -321,8 +512,11 @@ def main():
             pd.set_option('display.width', None)
             print(sample_df.to_string(index=False))
     
-    # Export data
-    analyzer.export_scotland_data(scotland_df)
+    # Export data, to the file named on the command line if given (e.g. scotland.parquet)
+    if len(sys.argv) > 1:
+        analyzer.export_scotland_data(scotland_df, sys.argv[1])
+    else:
+        analyzer.export_scotland_data(scotland_df)
     
     # Summary
     print(f"\n=== SUMMARY ===")